@@ -6,6 +6,16 @@ import gerber
 from .conversion import process_gerber
 
 
+def load_gerber(filename):
+    """Parses a gerber file, closing it as soon as it's read."""
+    # Gerber files are ASCII, but some tools write UTF-8 comments. Decoding explicitly avoids
+    # depending on the locale's default encoding, and matches the web service.
+    with open(filename, "r", encoding="utf-8") as gerber_file:
+        data = gerber_file.read()
+    # gerber.read() would do the same, but it opens files in the "rU" mode removed in python 3.11
+    return gerber.loads(data, filename=filename)
+
+
 def gerber_to_scad_cli():
     parser = argparse.ArgumentParser(
         description="Convert gerber files to an scad 3d printable solder stencil."
@@ -65,31 +75,27 @@ def gerber_to_scad_cli():
 
     args = parser.parse_args()
 
-    outline_file = open(args.outline_file, "r")
-    solderpaste_file = open(args.solderpaste_file, "r")
-
-    outline = gerber.loads(outline_file.read())
-    solder_paste = gerber.loads(solderpaste_file.read())
+    outline = load_gerber(args.outline_file)
+    solder_paste = load_gerber(args.solderpaste_file)
     with open(args.output_file, "w") as output_file:
-        output_file.write(
-            process_gerber(
-                outline_file=outline,
-                solderpaste_file=solder_paste,
-                stencil_thickness=args.thickness,
-                include_ledge=args.include_ledge,
-                ledge_thickness=args.ledge_thickness,
-                gap=args.gap,
-                increase_hole_size_by=args.increase_hole_size,
-                flip_stencil=args.flip,
-                include_frame=False,
-                frame_width=0,
-                frame_height=0,
-                frame_thickness=1.2,
-                simplify_regions=False,
-                stencil_width=0,
-                stencil_height=0,
-                stencil_margin=0,
-            )
+        process_gerber(
+            outline_file=outline,
+            solderpaste_file=solder_paste,
+            stencil_thickness=args.thickness,
+            include_ledge=args.include_ledge,
+            ledge_thickness=args.ledge_thickness,
+            gap=args.gap,
+            increase_hole_size_by=args.increase_hole_size,
+            flip_stencil=args.flip,
+            include_frame=False,
+            frame_width=0,
+            frame_height=0,
+            frame_thickness=1.2,
+            simplify_regions=False,
+            stencil_width=0,
+            stencil_height=0,
+            stencil_margin=0,
+            scad_file=output_file,
         )
 
 
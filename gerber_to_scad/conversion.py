@@ -1,7 +1,9 @@
+import logging
 import math
-from copy import copy
-from typing import List, Tuple, cast
+from collections import defaultdict, deque
+from typing import Dict, List, Optional, TextIO, Tuple, cast
 
+import numpy as np
 from gerber import primitives
 from gerber.am_statements import (
     AMOutlinePrimitive,
@@ -23,51 +25,50 @@ from solid import (
     offset,
 )
 from solid import utils
+from solid.solidpython import OpenSCADObject
 from .vector import V
 from . import geometry
 from . import gerber_helpers
 
-MAX_SEGMENT_LENGTH = 0.2
+logger = logging.getLogger(__name__)
 
+MAX_SEGMENT_LENGTH = 0.2
+# Line vertices closer than this (in mm) are joined together into shapes
+JOIN_TOLERANCE = 0.001
 
-def combine_faces_into_shapes(faces):
-    """Takes a list of faces and combines them into continuous shapes."""
-    shapes = []
+# Points on the unit circle by number of segments, shared by all circles of the same size
+UNIT_CIRCLES: Dict[int, np.ndarray] = {}
 
-    for face in faces:
-        if len(face) != 2:
-            raise Exception("face with more than two vertices")
 
-        v1 = face[0]
-        v2 = face[1]
+def round_points(points, decimal_places=3) -> np.ndarray:
+    """Round the coordinates of an (n, 2) array of points to some amount of decimal places."""
+    # Rounding half up on the scaled values is a lot cheaper than round(), which rounds
+    # correctly to the nearest decimal representation.
+    scale = 10**decimal_places
+    return np.floor(np.asarray(points, dtype=float) * scale + 0.5) / scale
 
-        for shape in shapes:
-            # Face is already in the shape
-            if v1 in shape and v2 in shape:
-                break
-            elif v1 in shape:
-                vertex_index = shape.index(v1)
-                # insert after existing vertex
-                shape.insert(vertex_index + 1, v2)
-                break
-            elif v2 in shape:
-                vertex_index = shape.index(v2)
-                # Insert before existing vertex
-                shape.insert(vertex_index, v1)
-                break
-        else:
-            # No existing vertex was found in any face
-            shapes.append(list(face))
 
-    return shapes
+def points_on_circle(center, radius: float, angles: np.ndarray) -> np.ndarray:
+    """Rasterize the points at the given angles (in radians) on a circle, rounded like round_points."""
+    return round_points(
+        np.column_stack(
+            (center[0] + np.cos(angles) * radius, center[1] + np.sin(angles) * radius)
+        )
+    )
 
 
-def make_v(v: Tuple[float, float], decimal_places=3) -> V:
-    """Round vertex coordinates to some amount of decimal places."""
-    return V(round(v[0], decimal_places), round(v[1], decimal_places))
+def unit_circle(num_segments: int) -> np.ndarray:
+    """Returns the points of a unit circle rasterized into num_segments segments."""
+    points = UNIT_CIRCLES.get(num_segments)
+    if points is None:
+        angles = np.arange(num_segments) * (2 * math.pi / num_segments)
+        points = UNIT_CIRCLES[num_segments] = np.column_stack(
+            (np.cos(angles), np.sin(angles))
+        )
+    return points
 
 
-def rect_from_line(line: primitives.Line):
+def rect_from_line(line: primitives.Line) -> np.ndarray:
     """Creates a rectangle from a line primitive by thickening it
     according to the primitive's aperture size.
 
@@ -76,185 +77,256 @@ def rect_from_line(line: primitives.Line):
     """
     r: float = gerber_helpers.get_aperture_size(line.aperture) / 2.0
 
-    start_v = V.from_tuple(line.start)
-    end_v = V.from_tuple(line.end)
+    start_x, start_y = line.start
+    end_x, end_y = line.end
 
-    dir_v = end_v - start_v
-    # normalize direction vector
-    abs_dir_v = abs(dir_v)
-    if abs_dir_v:
-        dir_v = dir_v / abs_dir_v
+    # Direction of the line, scaled to the aperture radius
+    dx = end_x - start_x
+    dy = end_y - start_y
+    length = math.hypot(dx, dy)
+    if length:
+        dx = dx / length * r
+        dy = dy / length * r
     else:
-        dir_v = V(0, 0)
+        dx = dy = 0.0
+
+    # The corners are the direction vector rotated by +-135 degrees at the start and +-45 degrees
+    # at the end, and stretched by sqrt(2) - i.e. one radius back or forward and one to the side.
+    return np.array(
+        [
+            (start_x - dx - dy, start_y + dx - dy),
+            (start_x - dx + dy, start_y - dx - dy),
+            (end_x + dx + dy, end_y - dx + dy),
+            (end_x + dx - dy, end_y + dx + dy),
+        ]
+    )
 
-    # 45 degree angle means the vector pointing to the new rectangle edges has to be sqrt(2)*r long
-    v_len = math.sqrt(2) * r
 
-    # Give the direction vector the appropriate length
-    dir_v = cast(V, dir_v * v_len)
+def line_to_shape(p, in_region, simplify_regions) -> np.ndarray:
+    # Lines are tricky: they're sometimes used to draw rounded rectangles by using a large aperture
+    # or they're used to outline shapes. For now, we'll just use those two cases:
+    # If a non-zero aperture size is set, we'll draw rectangles (treating circular apertures as square for now)
+    # otherwise we'll just use the lines directly (they're later joined into shapes)
 
-    v1 = start_v + dir_v.rotate(135, as_degrees=True)
-    v2 = start_v + dir_v.rotate(-135, as_degrees=True)
-    v3 = end_v + dir_v.rotate(-45, as_degrees=True)
-    v4 = end_v + dir_v.rotate(45, as_degrees=True)
+    # Lines in regions are always contours, so only other lines need their aperture checked
+    if not in_region:
+        length = math.hypot(p.end[0] - p.start[0], p.end[1] - p.start[1])
+        if gerber_helpers.has_wide_aperture(p.aperture, length=length):
+            return rect_from_line(p)
 
-    return [v1, v2, v3, v4]
+    return round_points((p.start, p.end))
 
 
-def primitive_to_shape(p, in_region=False, simplify_regions=False) -> List[V]:
-    """Turns a gerber primitive into an scad shape.
+def circle_to_shape(p, in_region, simplify_regions) -> np.ndarray:
+    # Rasterize circle, aiming for a hopefully reasonable segment length of 0.1mm
+    circ = math.pi * p.diameter
+    num_segments = max(1, int(round(circ / MAX_SEGMENT_LENGTH)))
 
-    If in_region is True, all shapes are assumed to be contours only, ignoring apertures.
-    """
-    # the primitives in sub-primitives sometimes aren't converted to metric when calling to_metric on the file,
-    # so we call it explicitly here:
-    if not isinstance(p, AMPrimitive) and p.units != "metric":
-        p.to_metric()
+    # Generate vertexes for each segment around the circle
+    return round_points(p.position + unit_circle(num_segments) * (p.diameter / 2))
 
-    vertices: List[V] = []
-    if isinstance(p, primitives.Line):
-        # Lines are tricky: they're sometimes used to draw rounded rectangles by using a large aperture
-        # or they're used to outline shapes. For now, we'll just use those two cases:
-        # If a non-zero aperture size is set, we'll draw rectangles (treating circular apertures as square for now)
-        # otherwise we'll just use the lines directly (they're later joined into shapes)
 
-        length = math.sqrt((p.start[0] - p.end[0]) ** 2 + (p.start[1] - p.end[1]) ** 2)
-        if not in_region and gerber_helpers.has_wide_aperture(
-            p.aperture, length=length
-        ):
-            vertices = rect_from_line(p)
-        else:
-            v1 = make_v(p.start)
-            v2 = make_v(p.end)
-            vertices = [v1, v2]
-    elif isinstance(p, (primitives.Circle, AMCirclePrimitive)):
-        # Rasterize circle, aiming for a hopefully reasonable segment length of 0.1mm
-        circ = math.pi * p.diameter
-        num_segments = max(1, int(round(circ / MAX_SEGMENT_LENGTH)))
-
-        # Generate vertexes for each segment around the circle
-        for s in range(0, num_segments):
-            angle = s * (2 * math.pi / num_segments)
-            x = p.position[0] + math.cos(angle) * p.diameter / 2
-            y = p.position[1] + math.sin(angle) * p.diameter / 2
-            vertices.append(make_v((x, y)))
-    elif isinstance(p, primitives.Rectangle):
-        v1 = make_v(p.lower_left)  # lower left
-        v2 = make_v((v1[0], v1[1] + p.height))  # top left
-        v3 = make_v((v2[0] + p.width, v2[1]))  # top right
-        v4 = make_v((v1[0] + p.width, v1[1]))  # bottom right
-        vertices = [v1, v2, v3, v4]
-    elif isinstance(p, AMCenterLinePrimitive):
-        # Essentially a rotated rectangle
-        print(f"Center line {p.rotation} deg")
-        center = p.center
-        angle_rad = p.rotation * math.pi / 180
-        cos_angle = math.cos(angle_rad)
-        sin_angle = math.sin(angle_rad)
-
-        p1 = (center[0] - p.width / 2, center[1] - p.height / 2)
-        p2 = (center[0] + p.width / 2, center[1] - p.height / 2)
-        p3 = (center[0] + p.width / 2, center[1] + p.height / 2)
-        p4 = (center[0] - p.width / 2, center[1] + p.height / 2)
-
-        # Rotate point about origin
-        # (x*cos(theta)-y*sin(theta), x*sin(theta)+y*cos(theta))
-        vertices = [
-            V(
-                p1[0] * cos_angle - p1[1] * sin_angle,
-                p1[0] * sin_angle + p1[1] * cos_angle,
-            ),
-            V(
-                p2[0] * cos_angle - p2[1] * sin_angle,
-                p2[0] * sin_angle + p2[1] * cos_angle,
-            ),
-            V(
-                p3[0] * cos_angle - p3[1] * sin_angle,
-                p3[0] * sin_angle + p3[1] * cos_angle,
-            ),
-            V(
-                p4[0] * cos_angle - p4[1] * sin_angle,
-                p4[0] * sin_angle + p4[1] * cos_angle,
-            ),
+def rectangle_to_shape(p, in_region, simplify_regions) -> np.ndarray:
+    # The other corners share their coordinates with the lower left and upper right corners
+    min_x, min_y = round_points(p.lower_left).tolist()
+    max_x = min_x + p.width
+    max_y = min_y + p.height
+    return round_points(
+        [
+            (min_x, min_y),  # lower left
+            (min_x, max_y),  # top left
+            (max_x, max_y),  # top right
+            (max_x, min_y),  # bottom right
         ]
-    elif isinstance(p, primitives.Region):
-        for sub_primitive in p.primitives:
-            vertices += [
-                vertex
-                for vertex in primitive_to_shape(sub_primitive, in_region=True)
-                if vertex not in vertices
-            ]
-        if simplify_regions:
-            vertices = list(geometry.bounding_box(vertices))
-    elif isinstance(p, primitives.Obround):
-        # We don't care about vertex duplication here because we'll just create a convex hull for the whole thing
-        for sub_primitive in p.subshapes.values():
-            vertices += primitive_to_shape(sub_primitive)
-        vertices = geometry.convex_hull(vertices)
-    elif isinstance(p, primitives.Arc):
-        if p.direction == "counterclockwise":
-            if p.end_angle <= p.start_angle:
-                sweep_angle = 360 - (p.start_angle - p.end_angle)
-            else:
-                sweep_angle = p.start_angle - p.end_angle
-        else:
-            if p.end_angle >= p.start_angle:
-                sweep_angle = 360 - (p.end_angle - p.start_angle)
-            else:
-                sweep_angle = p.start_angle - p.end_angle
+    )
+
 
-        arc_length = p.radius * sweep_angle
-        num_segments = max(1, int(round(arc_length / MAX_SEGMENT_LENGTH)))
-        angle_delta = sweep_angle / num_segments
+def center_line_to_shape(p, in_region, simplify_regions) -> np.ndarray:
+    # Essentially a rotated rectangle
+    logger.debug("Center line %s deg", p.rotation)
+    center_x, center_y = p.center
+    half_width = p.width / 2
+    half_height = p.height / 2
+    corners = np.array(
+        [
+            (center_x - half_width, center_y - half_height),
+            (center_x + half_width, center_y - half_height),
+            (center_x + half_width, center_y + half_height),
+            (center_x - half_width, center_y + half_height),
+        ]
+    )
 
-        angle = p.start_angle
+    # Rotate the corners about the origin
+    angle_rad = p.rotation * math.pi / 180
+    cos_angle = math.cos(angle_rad)
+    sin_angle = math.sin(angle_rad)
+    rotation = np.array([(cos_angle, -sin_angle), (sin_angle, cos_angle)])
+    return corners @ rotation.T
 
-        for s in range(0, num_segments):
-            x = p.center[0] + math.cos(angle) * p.radius
-            y = p.center[1] + math.sin(angle) * p.radius
-            vertices.append(make_v((x, y)))
 
-            angle = (
-                angle + angle_delta
-                if p.direction == "counterclockwise"
-                else angle - angle_delta
+def region_to_shape(p, in_region, simplify_regions) -> np.ndarray:
+    vertices = np.concatenate(
+        [np.empty((0, 2))]
+        + [
+            primitive_to_shape(sub_primitive, in_region=True)
+            for sub_primitive in p.primitives
+        ]
+    )
+    # Sub shapes share their end points, so only keep the first occurrence of each vertex
+    _, first_indices = np.unique(vertices, axis=0, return_index=True)
+    shape = vertices[np.sort(first_indices)]
+    if simplify_regions:
+        shape = geometry.bounding_box(shape)
+    return shape
+
+
+def obround_to_shape(p, in_region, simplify_regions) -> np.ndarray:
+    # An obround is the convex hull of its two end circles, which we build directly instead of
+    # rasterizing all its sub shapes and hulling them: the outer half of each circle (rasterized
+    # like circle_to_shape would), joined by the corners of the rectangle between the circles.
+    x, y = p.position
+    radius = min(p.width, p.height) / 2
+    offset = abs(p.width - p.height) / 2
+
+    num_segments = max(1, int(round(math.pi * 2 * radius / MAX_SEGMENT_LENGTH)))
+    circle = unit_circle(num_segments) * radius
+    # Angles in quarter turns (scaled by num_segments), to pick the arcs without rounding errors
+    quarters = np.arange(0, 4 * num_segments, 4)
+
+    if p.orientation == "vertical":
+        right_side = round_points([(x + radius, y - offset), (x + radius, y + offset)])
+        top_arc = round_points(
+            (x, y + offset) + circle[(quarters > 0) & (quarters < 2 * num_segments)]
+        )
+        left_side = round_points([(x - radius, y + offset), (x - radius, y - offset)])
+        bottom_arc = round_points((x, y - offset) + circle[quarters > 2 * num_segments])
+        outline = [right_side, top_arc, left_side, bottom_arc]
+    else:
+        top_side = round_points([(x + offset, y + radius), (x - offset, y + radius)])
+        left_arc = round_points(
+            (x - offset, y)
+            + circle[(quarters > num_segments) & (quarters < 3 * num_segments)]
+        )
+        bottom_side = round_points([(x - offset, y - radius), (x + offset, y - radius)])
+        right_arc = round_points(
+            (x + offset, y)
+            + np.concatenate(
+                (circle[quarters > 3 * num_segments], circle[quarters < num_segments])
             )
+        )
+        outline = [top_side, left_arc, bottom_side, right_arc]
+
+    if not offset:
+        # Both ends are the same circle, so the corners on each side coincide
+        outline[0] = outline[0][:1]
+        outline[2] = outline[2][:1]
 
-    elif isinstance(p, AMOutlinePrimitive):
-        return [make_v(point) for point in p.points]
-    elif isinstance(p, AMVectorLinePrimitive):
-        # A vector line with a given thickness - we turn this into a rotated rectangle
-        start_v = V.from_tuple(p.start)
-        end_v = V.from_tuple(p.end)
-
-        dir_v = end_v - start_v
-        # normalize direction vector
-        abs_dir_v = abs(dir_v)
-        if abs_dir_v:
-            dir_v = dir_v / abs_dir_v
+    return np.concatenate(outline)
+
+
+def arc_to_shape(p, in_region, simplify_regions) -> np.ndarray:
+    counterclockwise = p.direction == "counterclockwise"
+    if counterclockwise:
+        if p.end_angle <= p.start_angle:
+            sweep_angle = 360 - (p.start_angle - p.end_angle)
+        else:
+            sweep_angle = p.start_angle - p.end_angle
+    else:
+        if p.end_angle >= p.start_angle:
+            sweep_angle = 360 - (p.end_angle - p.start_angle)
         else:
-            dir_v = V(0, 0)
+            sweep_angle = p.start_angle - p.end_angle
 
-        # Give the direction vector the appropriate length
-        dir_v = cast(V, dir_v * p.width / 2)
+    arc_length = p.radius * sweep_angle
+    num_segments = max(1, int(round(arc_length / MAX_SEGMENT_LENGTH)))
+    # The direction is folded into the sign of the step between segments
+    angle_delta = (1.0 if counterclockwise else -1.0) * sweep_angle / num_segments
 
-        v1 = start_v + dir_v.rotate(90, as_degrees=True)
-        v2 = start_v + dir_v.rotate(-90, as_degrees=True)
-        v3 = end_v + dir_v.rotate(-90, as_degrees=True)
-        v4 = end_v + dir_v.rotate(90, as_degrees=True)
+    angles = p.start_angle + np.arange(num_segments) * angle_delta
+    return points_on_circle(p.center, p.radius, angles)
 
-        return [v1, v2, v3, v4]
 
-    elif isinstance(p, AMCommentPrimitive):
-        return []
+def outline_to_shape(p, in_region, simplify_regions) -> np.ndarray:
+    return round_points(p.points)
+
+
+def vector_line_to_shape(p, in_region, simplify_regions) -> np.ndarray:
+    # A vector line with a given thickness - we turn this into a rotated rectangle
+    start_v = V.from_tuple(p.start)
+    end_v = V.from_tuple(p.end)
+
+    dir_v = end_v - start_v
+    # normalize direction vector
+    abs_dir_v = abs(dir_v)
+    if abs_dir_v:
+        dir_v = dir_v / abs_dir_v
     else:
-        raise NotImplementedError("Unexpected primitive type {}".format(type(p)))
-    return vertices
+        dir_v = V(0, 0)
+
+    # Give the direction vector the appropriate length
+    dir_v = cast(V, dir_v * p.width / 2)
+
+    # The direction rotated by 90 degrees, without going through cos/sin
+    normal_v = V(-dir_v.y, dir_v.x)
+
+    v1 = start_v + normal_v
+    v2 = start_v - normal_v
+    v3 = end_v - normal_v
+    v4 = end_v + normal_v
+
+    return np.array([v1.as_tuple(), v2.as_tuple(), v3.as_tuple(), v4.as_tuple()])
+
+
+def comment_to_shape(p, in_region, simplify_regions) -> np.ndarray:
+    return np.empty((0, 2))
+
+
+# Shape converters by primitive type, subclasses use the converter of their closest base class
+SHAPE_CONVERTERS = {
+    primitives.Line: line_to_shape,
+    primitives.Circle: circle_to_shape,
+    AMCirclePrimitive: circle_to_shape,
+    primitives.Rectangle: rectangle_to_shape,
+    AMCenterLinePrimitive: center_line_to_shape,
+    primitives.Region: region_to_shape,
+    primitives.Obround: obround_to_shape,
+    primitives.Arc: arc_to_shape,
+    AMOutlinePrimitive: outline_to_shape,
+    AMVectorLinePrimitive: vector_line_to_shape,
+    AMCommentPrimitive: comment_to_shape,
+}
+
+
+def shape_converter(primitive_type):
+    converter = SHAPE_CONVERTERS.get(primitive_type)
+    if converter is None:
+        for base in primitive_type.__mro__[1:]:
+            if base in SHAPE_CONVERTERS:
+                converter = SHAPE_CONVERTERS[primitive_type] = SHAPE_CONVERTERS[base]
+                break
+        else:
+            raise NotImplementedError(
+                "Unexpected primitive type {}".format(primitive_type)
+            )
+    return converter
+
+
+def primitive_to_shape(p, in_region=False, simplify_regions=False) -> np.ndarray:
+    """Turns a gerber primitive into an scad shape, as an (n, 2) array of points.
+
+    If in_region is True, all shapes are assumed to be contours only, ignoring apertures.
+    """
+    # the primitives in sub-primitives sometimes aren't converted to metric when calling to_metric on the file,
+    # so we call it explicitly here. Converting sets the units to metric, so each primitive is only
+    # converted once, and primitives we create ourselves (without units) are skipped entirely.
+    if not isinstance(p, AMPrimitive) and p.units == "inch":
+        p.to_metric()
+
+    return shape_converter(type(p))(p, in_region, simplify_regions)
 
 
-def create_outline_shape_rect(outline) -> List[V]:
+def create_outline_shape_rect(outline) -> np.ndarray:
     outline.to_metric()
-    outline_vertices: List[V] = []
 
     # For some reason, some boards don't have any primitives but just some rectangular bounds
     # In that case, we just use those bounds as a rectangle defining the board
@@ -265,129 +337,207 @@ def create_outline_shape_rect(outline) -> List[V]:
     min_x, max_x = bounds[0]
     min_y, max_y = bounds[1]
 
-    outline_vertices += [
-        V(min_x, min_y),
-        V(min_x, max_y),
-        V(max_x, max_y),
-        V(max_x, min_y),
-    ]
-
-    return geometry.convex_hull(outline_vertices)
+    # The bounds already are a convex shape, so we return them in counter-clockwise order
+    # like the convex hull would, without computing it.
+    return np.array(
+        [(min_x, min_y), (max_x, min_y), (max_x, max_y), (min_x, max_y)], dtype=float
+    )
 
 
-def outline_shape_from_file(outline) -> List[V]:
+def outline_shape_from_file(outline) -> np.ndarray:
     outline.to_metric()
-    outline_vertices: List[V] = []
 
     if outline.primitives:
+        if len(outline.primitives) == 1 and isinstance(
+            outline.primitives[0], primitives.Rectangle
+        ):
+            # A single rectangle is its own convex hull, only the order of its corners
+            # has to be turned counter-clockwise.
+            return primitive_to_shape(outline.primitives[0])[::-1]
+
+        outline_shapes: List[np.ndarray] = []
         for p in outline.primitives:
             if type(p) == primitives.AMGroup:
-                print(f"Ignoring AMGroup {p}")
+                logger.warning("Ignoring AMGroup %s", p)
                 continue
-            outline_vertices += primitive_to_shape(p)
-        return geometry.convex_hull(outline_vertices)
+            outline_shapes.append(primitive_to_shape(p))
+        return geometry.convex_hull(np.concatenate(outline_shapes))
     else:
         return create_outline_shape_rect(outline)
 
 
-def offset_shape(shape: List[V], offset) -> List[V]:
-    """Offset a shape by <offset> mm."""
+def offset_shape(shape: np.ndarray, offset) -> np.ndarray:
+    """Offset a shape by <offset> mm.
 
-    return [
-        V(p[0], p[1])
-        for p in utils.offset_points(
-            [v.as_tuple() for v in shape],
-            abs(offset),
-            internal=offset < 0,  # type: ignore
-        )
-    ]
+    Every edge is moved outwards (inwards for negative offsets) and the new vertices are where
+    neighbouring edges meet, so corners stay sharp.
+    """
+    points = np.asarray(shape, dtype=float)
+    following_points = np.roll(points, -1, axis=0)
+    edges = following_points - points
+
+    # The outward side of the edges depends on the winding order of the shape
+    doubled_area = np.sum(
+        points[:, 0] * following_points[:, 1] - following_points[:, 0] * points[:, 1]
+    )
+    winding = 1 if doubled_area > 0 else -1
+    normals = (
+        winding
+        * np.column_stack((edges[:, 1], -edges[:, 0]))
+        / np.hypot(edges[:, 0], edges[:, 1])[:, None]
+    )
 
+    # Each vertex joins the previous edge and its own edge. Moving it by
+    # offset * (n1 + n2) / (1 + n1 * n2) puts it on both offset edges.
+    previous_normals = np.roll(normals, 1, axis=0)
+    miters = (previous_normals + normals) / (
+        1 + np.sum(previous_normals * normals, axis=1)
+    )[:, None]
+    return points + offset * miters
 
-def find_line_closest_to_point(point, lines):
-    """Finds the line from a list of lines that is closest to `point`.
-    Returns a bunch of information about the closest line.
+
+def grid_cell(point) -> Tuple[int, int]:
+    """Returns the cell of the JOIN_TOLERANCE sized grid a point lies in."""
+    return (
+        math.floor(point[0] / JOIN_TOLERANCE),
+        math.floor(point[1] / JOIN_TOLERANCE),
+    )
+
+
+def index_line_vertices(lines) -> Dict[Tuple[int, int], List[Tuple[int, int]]]:
+    """Sorts the vertices of all lines into grid cells, as (line index, vertex index) pairs.
+
+    Any vertex within JOIN_TOLERANCE of a point lies in the point's cell or one of its neighbours,
+    so close vertices can be found without looking at every line.
     """
-    d = float("inf")
-    closest_vertex = None
-    far_vertex = None
-    closest_line_index = None
+    grid: Dict[Tuple[int, int], List[Tuple[int, int]]] = defaultdict(list)
     for line_index, line in enumerate(lines):
         for vertex_index, vertex in enumerate(line):
-            point_d = (vertex[0] - point[0]) ** 2 + (vertex[1] - point[1]) ** 2
-            if point_d < d and point_d < (0.001) ** 2:
-                d = point_d
-                closest_vertex = vertex
-                far_vertex = line[vertex_index - 1]  # 0 or -1
-                closest_line_index = line_index
+            grid[grid_cell(vertex)].append((line_index, vertex_index))
+    return grid
 
+
+def find_line_closest_to_point(point, lines, grid, alive):
+    """Finds the line from a list of lines that is closest to `point`.
+    `grid` is the index of the lines' vertices (see index_line_vertices), and lines
+    are skipped unless they're marked in `alive`.
+    Returns a bunch of information about the closest line.
+    """
+    closest = (float("inf"), None, None)
+    cell_x, cell_y = grid_cell(point)
+    for x in (cell_x - 1, cell_x, cell_x + 1):
+        for y in (cell_y - 1, cell_y, cell_y + 1):
+            for line_index, vertex_index in grid.get((x, y), ()):
+                if not alive[line_index]:
+                    continue
+                vertex = lines[line_index][vertex_index]
+                point_d = (vertex[0] - point[0]) ** 2 + (vertex[1] - point[1]) ** 2
+                # Ties go to the first line, like they would when scanning the lines in order
+                candidate = (point_d, line_index, vertex_index)
+                if point_d < JOIN_TOLERANCE**2 and candidate < closest:
+                    closest = candidate
+
+    _, closest_line_index, vertex_index = closest
+    if closest_line_index is None:
+        return {"closest_line_index": None, "close_vertex": None, "far_vertex": None}
+
+    line = lines[closest_line_index]
     return {
         "closest_line_index": closest_line_index,
-        "close_vertex": closest_vertex,
-        "far_vertex": far_vertex,
+        "close_vertex": line[vertex_index],
+        "far_vertex": line[vertex_index - 1],  # 0 or -1
     }
 
 
-def lines_to_shapes(lines: List[List[V]]) -> List[List[V]]:
+def lines_to_shapes(lines: List[np.ndarray]) -> List[np.ndarray]:
     """Takes a list of lines and joins them together into shapes.
 
     1) Starts the first shape with the first line
     2) Looks for other line segments that are close to its end points (first or last vertex)
     3) If it finds a close line it discards the close point and appends the second point to the shape
-    4) The found line is removed from the list of lines.
+    4) The found line is marked as used, so it is not considered again.
     5) Repeats the process with the new shape, again looking for lines close to its (new) end points
     6) Once no more close shapes are found, the first shape is closed and the process starts over with the next remaining line
     """
-    # lines = deepcopy(lines)
-    if not lines:
-        return []
-
-    shapes: List[List[V]] = []
-    shape = copy(lines[0])
-    lines = lines[1:]
-
-    while True:
-        # Try to find a point close to the start of the shape
-        start_point_info = find_line_closest_to_point(shape[0], lines)
-        if start_point_info["closest_line_index"] is not None:
-            shape.insert(0, start_point_info["far_vertex"])
-            del lines[start_point_info["closest_line_index"]]
-            continue
+    shapes: List[np.ndarray] = []
+    # Single coordinates are a lot quicker to look at in lists than in arrays
+    lines = [line.tolist() for line in lines]
+    grid = index_line_vertices(lines)
+    # Lines aren't removed from the list (or the grid), just marked as no longer available
+    alive = bytearray(b"\x01") * len(lines)
 
-        # If no point close to the start was found, try to find a point close to the end of the shape
-        end_point_info = find_line_closest_to_point(shape[-1], lines)
-        if end_point_info["closest_line_index"] is not None:
-            shape.append(end_point_info["far_vertex"])
-            del lines[end_point_info["closest_line_index"]]
+    for line_index, line in enumerate(lines):
+        if not alive[line_index]:
             continue
 
-        # There is no close point to this shape, so it must be finished.
-        shapes.append(shape)
+        shape = deque(line)
+        alive[line_index] = 0
 
-        # While there are lines remaining, chose the next one as the start of the next shape
-        if lines:
-            shape = copy(lines[0])
-            lines = lines[1:]
-        else:
+        while True:
+            # Try to find a point close to the start of the shape
+            start_point_info = find_line_closest_to_point(shape[0], lines, grid, alive)
+            if start_point_info["closest_line_index"] is not None:
+                shape.appendleft(start_point_info["far_vertex"])
+                alive[start_point_info["closest_line_index"]] = 0
+                continue
+
+            # If no point close to the start was found, try to find a point close to the end of the shape
+            end_point_info = find_line_closest_to_point(shape[-1], lines, grid, alive)
+            if end_point_info["closest_line_index"] is not None:
+                shape.append(end_point_info["far_vertex"])
+                alive[end_point_info["closest_line_index"]] = 0
+                continue
+
+            # There is no close point to this shape, so it must be finished.
             break
 
+        shapes.append(np.array(shape, dtype=float))
+
     # shapes = [convex_hull(shape) for shape in shapes if len(shape) > 2]
     return shapes
 
 
+def flash_shape(aperture) -> np.ndarray:
+    """Turns a standard (circle, rectangle or obround) aperture into a shape centered on the origin."""
+    if aperture["shape"] == "C":  # circle
+        return primitive_to_shape(
+            primitives.Circle(diameter=aperture["modifiers"][0][0], position=[0, 0])
+        )
+    elif aperture["shape"] == "R":  # rectangle
+        width, height = aperture["modifiers"][0]
+        return primitive_to_shape(
+            primitives.Rectangle(position=[0, 0], width=width, height=height)
+        )
+    elif aperture["shape"] == "O":  # obround
+        width, height = aperture["modifiers"][0]
+        return primitive_to_shape(primitives.Obround((0, 0), width, height))
+    raise NotImplementedError(f"Unsupported flash aperture {aperture['shape']}")
+
+
 def create_cutouts(solder_paste, increase_hole_size_by=0.0, simplify_regions=False):
+    """Creates the union of all cutouts in the solder paste file.
+
+    Returns the union and a list of module definitions it uses, which have to be rendered
+    into the file header.
+    """
     solder_paste.to_metric()
 
-    cutout_shapes: List[List[V]] = []
-    cutout_lines: List[List[V]] = []
+    cutout_shapes: List[np.ndarray] = []
+    cutout_lines: List[np.ndarray] = []
 
     apertures = {}
     # Aperture macros are saved as a list of shapes
     aperture_macros = {}
+    # Standard apertures are defined as a module once, and each flash places a copy of it
+    flashed_apertures = {}
+    flash_positions: Dict[int, List[Tuple[float, float]]] = defaultdict(list)
     current_aperture = None
     current_x = 0
     current_y = 0
     for statement in solder_paste.statements:
-        if statement.type == "PARAM":
+        # Statement attributes are looked up once, not again in every branch
+        statement_type = statement.type
+        if statement_type == "PARAM":
             if statement.param == "AD":
                 # define aperture
                 apertures[statement.d] = {
@@ -396,75 +546,49 @@ def create_cutouts(solder_paste, increase_hole_size_by=0.0, simplify_regions=Fal
                 }
             elif statement.param == "AM":
                 # Aperture macro
-                aperture_macros[statement.name] = []
-                for primitive in statement.primitives:
-                    aperture_macros[statement.name].append(
-                        primitive_to_shape(primitive)
-                    )
+                aperture_macros[statement.name] = [
+                    primitive_to_shape(primitive) for primitive in statement.primitives
+                ]
 
-        elif statement.type == "APERTURE":
+        elif statement_type == "APERTURE":
             current_aperture = statement.d
-        elif statement.type == "COORD" and statement.op in ["D02", "D2"]:
+        elif statement_type == "COORD" and statement.op in ("D02", "D2"):
             # Move coordinates
-            if statement.x is not None:
-                current_x = statement.x
-            if statement.y is not None:
-                current_y = statement.y
-        elif statement.type == "COORD" and statement.op in [
-            "D03",
-            "D3",
-        ]:  # flash object coordinates
+            x, y = statement.x, statement.y
+            if x is not None:
+                current_x = x
+            if y is not None:
+                current_y = y
+        elif statement_type == "COORD" and statement.op in ("D03", "D3"):
+            # flash object coordinates
             if not current_aperture:
                 raise Exception("No aperture set on flash object coordinates!")
 
             aperture = apertures[current_aperture]
-            current_x = statement.x if statement.x is not None else current_x
-            current_y = statement.y if statement.y is not None else current_y
-            if aperture["shape"] == "C":  # circle
-                cutout_shapes.append(
-                    primitive_to_shape(
-                        primitives.Circle(
-                            diameter=aperture["modifiers"][0][0],
-                            position=[current_x, current_y],
-                        )
-                    )
+            aperture_shape = aperture["shape"]
+            x, y = statement.x, statement.y
+            current_x = x if x is not None else current_x
+            current_y = y if y is not None else current_y
+            if aperture_shape in ("C", "R", "O"):
+                flashed_apertures.setdefault(current_aperture, aperture)
+                flash_positions[current_aperture].append((current_x, current_y))
+            elif aperture_shape in aperture_macros:  # Aperture macro shape
+                # Offset all points in the macro and add the resulting shapes
+                cutout_shapes.extend(
+                    macro_shape + (current_x, current_y)
+                    for macro_shape in aperture_macros[aperture_shape]
                 )
-            elif aperture["shape"] == "R":  # rectangle
-                width, height = aperture["modifiers"][0]
-                print(f"Rect X: {current_x} Y: {current_y}")
-                cutout_shapes.append(
-                    primitive_to_shape(
-                        primitives.Rectangle(
-                            position=[current_x, current_y],
-                            width=width,
-                            height=height,
-                        )
-                    )
-                )
-            elif aperture["shape"] == "O":  # obround
-                width, height = aperture["modifiers"][0]
-                print(f"Obround at {current_x},{current_y}")
-                obround = primitives.Obround((0, 0), width, height)
-                shape = primitive_to_shape(obround)
-                positioned_shape = [
-                    V(p[0] + current_x, p[1] + current_y) for p in shape
-                ]
-                cutout_shapes.append(positioned_shape)
-            elif aperture["shape"] in aperture_macros:  # Aperture macro shape
-                for macro_shape in aperture_macros[aperture["shape"]]:
-                    # Offset all points in the macro and add the resulting shape
-                    shape = [V(p[0] + current_x, p[1] + current_y) for p in macro_shape]
-                    cutout_shapes.append(shape)
             else:
                 raise NotImplementedError(
-                    f"Unsupported flash aperture {aperture['shape']}"
+                    f"Unsupported flash aperture {aperture_shape}"
                 )
         else:
             pass
 
+    # Flashes (including aperture macros, which show up as AMGroups) are already
+    # added from the statements above, so only the drawn primitives are left to convert.
     for p in solder_paste.primitives:
-        if type(p) == primitives.AMGroup:
-            print(f"Ignoring AMGroup {p}")
+        if p.flashed:
             continue
         shape = primitive_to_shape(p, simplify_regions=simplify_regions)
         if len(shape) > 2:
@@ -475,13 +599,51 @@ def create_cutouts(solder_paste, increase_hole_size_by=0.0, simplify_regions=Fal
     # If the cutouts contain lines we try to first join them together into shapes
     cutout_shapes += lines_to_shapes(cutout_lines)
     polygons = []
+    modules = []
+    # Module names by aperture definition, so apertures that are defined the same way under
+    # different numbers share a module
+    module_names: Dict[tuple, str] = {}
+    for aperture_name, aperture in flashed_apertures.items():
+        definition = (aperture["shape"], tuple(map(tuple, aperture["modifiers"])))
+        module_name = module_names.get(definition)
+        if module_name is None:
+            # Rasterize the aperture once around the origin
+            module_name = module_names[definition] = f"aperture_{aperture_name}"
+            shape = flash_shape(aperture)
+            shape_polygon = polygon(shape.tolist())
+            if increase_hole_size_by and len(shape) > 2:
+                shape_polygon = offset(delta=increase_hole_size_by)(shape_polygon)
+            modules.append(OpenSCADObject(f"module {module_name}", {})(shape_polygon))
+
+        for x, y in round_points(flash_positions[aperture_name]).tolist():
+            polygons.append(translate((x, y, 0))(OpenSCADObject(module_name, {})))
+
     for shape in cutout_shapes:
-        shape_polygon = polygon([(x, y) for x, y in shape])
+        shape_polygon = polygon(shape.tolist())
         if increase_hole_size_by and len(shape) > 2:
             shape_polygon = offset(delta=increase_hole_size_by)(shape_polygon)
         polygons.append(shape_polygon)
 
-    return union()(*polygons)
+    return union()(*polygons), modules
+
+
+def write_scad_object(scad_object, scad_file: TextIO, level: int = 0):
+    """Writes an scad object to a file, rendered like scad_render would.
+
+    scad_render builds the code of every object from the code of its children, copying it once
+    for every level of nesting. This writes the objects one at a time instead, so the code never
+    has to be held in memory as a whole. Holes and parts aren't supported.
+    """
+    indentation = "\t" * level
+    code = scad_object._render_str_no_children().replace("\n", "\n" + indentation)
+    if not scad_object.children:
+        scad_file.write(code + ";")
+        return
+
+    scad_file.write(code + " {")
+    for child in scad_object.children:
+        write_scad_object(child, scad_file, level + 1)
+    scad_file.write("\n" + indentation + "}")
 
 
 def process_gerber(
@@ -502,8 +664,12 @@ def process_gerber(
     stencil_width: float,
     stencil_height: float,
     stencil_margin: float,
-):
-    """Convert gerber outline and solderpaste files to an scad file."""
+    scad_file: Optional[TextIO] = None,
+) -> Optional[str]:
+    """Convert gerber outline and solderpaste files to an scad file.
+
+    The scad code is returned as a string, or written to scad_file if one is given.
+    """
     if outline_file:
         outline_shape = outline_shape_from_file(outline_file)
     else:
@@ -515,7 +681,7 @@ def process_gerber(
             margin=stencil_margin,
         )
 
-    cutout_polygon = create_cutouts(
+    cutout_polygon, cutout_modules = create_cutouts(
         solderpaste_file,
         increase_hole_size_by=increase_hole_size_by,
         simplify_regions=simplify_regions,
@@ -526,18 +692,18 @@ def process_gerber(
 
     if gap:
         # Add a gap around the outline
-        outline_shape = offset_shape(list(outline_shape), gap)
-    outline_polygon = polygon([v.as_tuple() for v in outline_shape])
+        outline_shape = offset_shape(outline_shape, gap)
+    outline_polygon = polygon(outline_shape.tolist())
 
     # Move the polygons to be centered around the origin
     outline_bounds = geometry.bounding_box(outline_shape)
-    outline_offset = outline_bounds[0] + (outline_bounds[2] - outline_bounds[0]) / 2
-    outline_polygon = translate((-outline_offset[0], -outline_offset[1], 0))(
-        outline_polygon
-    )
-    cutout_polygon = translate((-outline_offset[0], -outline_offset[1], 0))(
-        cutout_polygon
-    )
+    center_x, center_y = (
+        outline_bounds[0] + (outline_bounds[2] - outline_bounds[0]) / 2
+    ).tolist()
+    # Every polygon is moved by the same amount
+    centering = (-center_x, -center_y, 0)
+    outline_polygon = translate(centering)(outline_polygon)
+    cutout_polygon = translate(centering)(cutout_polygon)
 
     if flip_stencil:
         mirror_normal = (-1, 0, 0)
@@ -548,31 +714,26 @@ def process_gerber(
     stencil = linear_extrude(height=stencil_thickness)(outline_polygon - cutout_polygon)
 
     if include_ledge:
-        ledge_shape = offset_shape(list(outline_shape), 1.2)
+        ledge_shape = offset_shape(outline_shape, 1.2)
         ledge_polygon = (
-            translate((-outline_offset[0], -outline_offset[1], 0))(
-                polygon([v.as_tuple() for v in ledge_shape])
-            )
-            - outline_polygon
+            translate(centering)(polygon(ledge_shape.tolist())) - outline_polygon
         )
 
         # Cut the ledge in half by taking the bounding box of the outline, cutting it in half
         # and removing the resulting shape from the ledge shape
         # We always leave the longer side of the ledge intact so we don't end up with a tiny ledge.
         cutter = geometry.bounding_box(ledge_shape)
-        height = abs(cutter[1][1] - cutter[0][1])
-        width = abs(cutter[0][0] - cutter[3][0])
+        height = abs(cutter[1, 1] - cutter[0, 1])
+        width = abs(cutter[0, 0] - cutter[3, 0])
 
         if width > height:
-            cutter[1].y -= height / 2
-            cutter[2].y -= height / 2
+            cutter[1, 1] -= height / 2
+            cutter[2, 1] -= height / 2
         else:
-            cutter[2].x -= width / 2
-            cutter[3].x -= width / 2
+            cutter[2, 0] -= width / 2
+            cutter[3, 0] -= width / 2
 
-        ledge_polygon = ledge_polygon - translate(
-            (-outline_offset[0], -outline_offset[1], 0)
-        )(polygon([v.as_tuple() for v in cutter]))
+        ledge_polygon = ledge_polygon - translate(centering)(polygon(cutter.tolist()))
 
         ledge = utils.down(ledge_thickness - stencil_thickness)(
             linear_extrude(height=ledge_thickness)(ledge_polygon)
@@ -583,10 +744,7 @@ def process_gerber(
             outline_shape, width=frame_width, height=frame_height
         )
         frame_polygon = (
-            translate((-outline_offset[0], -outline_offset[1], 0))(
-                polygon([v.as_tuple() for v in frame_shape])
-            )
-            - outline_polygon
+            translate(centering)(polygon(frame_shape.tolist())) - outline_polygon
         )
 
         frame = utils.down(frame_thickness - stencil_thickness)(
@@ -600,4 +758,23 @@ def process_gerber(
     # for debugging, output just the cutout polygon (extruded)
     # return scad_render(linear_extrude(height=stencil_thickness)(cutout_polygon))
 
-    return scad_render(stencil)
+    # Streaming relies on a private solidpython method, so without it the code is rendered as a whole
+    if scad_file is None or not hasattr(stencil, "_render_str_no_children"):
+        scad_code = scad_render(
+            stencil,
+            file_header="".join(scad_render(module) for module in cutout_modules),
+        )
+        if scad_file is None:
+            return scad_code
+        scad_file.write(scad_code)
+        return None
+
+    # Same layout as scad_render, with the modules in the file header
+    for module in cutout_modules:
+        scad_file.write("\n")
+        write_scad_object(module, scad_file)
+    if cutout_modules:
+        scad_file.write("\n")
+    scad_file.write("\n")
+    write_scad_object(stencil, scad_file)
+    return None
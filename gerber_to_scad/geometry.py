@@ -1,17 +1,23 @@
-"""Geometry helpers"""
+"""Geometry helpers
 
-from scipy.spatial import ConvexHull
-from .vector import V
-from typing import Tuple, List
+Shapes are (n, 2) numpy arrays of points.
+"""
+
+import numpy as np
+from scipy.spatial import ConvexHull, QhullError
+
+# Hulls of up to this many points are computed directly, which is quicker than setting up qhull
+SMALL_HULL_SIZE = 32
+# Turns smaller than this (in mm^2) are treated as straight, so points on an edge of the hull are dropped
+COLLINEAR_TOLERANCE = 1e-9
 
 
 def bounding_box(
     shape, width: float = 0, height: float = 0, margin: float = 0
-) -> Tuple[V, V, V, V]:
-    min_x = min(shape, key=lambda v: v[0])[0]
-    max_x = max(shape, key=lambda v: v[0])[0]
-    min_y = min(shape, key=lambda v: v[1])[1]
-    max_y = max(shape, key=lambda v: v[1])[1]
+) -> np.ndarray:
+    points = np.asarray(shape, dtype=float)
+    min_x, min_y = points.min(axis=0).tolist()
+    max_x, max_y = points.max(axis=0).tolist()
     if (float(width or 0) > 0 and float(height or 0) > 0) or float(margin or 0) > 0:
         if margin > 0:
             margin_x = margin
@@ -19,17 +25,64 @@ def bounding_box(
         else:
             margin_x = (width - (max_x - min_x)) / 2
             margin_y = (height - (max_y - min_y)) / 2
-        return (
-            V(min_x - margin_x, min_y - margin_y),
-            V(min_x - margin_x, max_y + margin_y),
-            V(max_x + margin_x, max_y + margin_y),
-            V(max_x + margin_x, min_y - margin_y),
-        )
-    return (V(min_x, min_y), V(min_x, max_y), V(max_x, max_y), V(max_x, min_y))
+        min_x -= margin_x
+        max_x += margin_x
+        min_y -= margin_y
+        max_y += margin_y
+    return np.array([(min_x, min_y), (min_x, max_y), (max_x, max_y), (max_x, min_y)])
+
+
+def cross(o, a, b) -> float:
+    """Cross product of the vectors o->a and o->b, positive if o, a, b turn counter-clockwise."""
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+
+def graham_scan(points) -> np.ndarray:
+    """Convex hull of a few points, in counter-clockwise order like convex_hull.
 
+    Uses the monotone chain variant of the Graham scan: the points are sorted by x and y, and the
+    lower and upper halves of the hull are built by dropping every point that doesn't turn left.
+    """
+    points = sorted(set(map(tuple, np.asarray(points, dtype=float).tolist())))
+    if len(points) < 3:
+        return np.array(points, dtype=float).reshape(-1, 2)
 
-def convex_hull(points: List[V]) -> List[V]:
-    hull = ConvexHull([v.as_tuple() for v in points])
+    lower: list = []
+    for point in points:
+        while (
+            len(lower) >= 2
+            and cross(lower[-2], lower[-1], point) <= COLLINEAR_TOLERANCE
+        ):
+            lower.pop()
+        lower.append(point)
+
+    upper: list = []
+    for point in reversed(points):
+        while (
+            len(upper) >= 2
+            and cross(upper[-2], upper[-1], point) <= COLLINEAR_TOLERANCE
+        ):
+            upper.pop()
+        upper.append(point)
+
+    # The last point of each half is the first point of the other one
+    return np.array(lower[:-1] + upper[:-1], dtype=float)
+
+
+def convex_hull(points) -> np.ndarray:
+    points = np.asarray(points, dtype=float)
+    if len(points) <= SMALL_HULL_SIZE:
+        hull_points = graham_scan(points)
+        # The scan reduces flat inputs to their outermost points, where qhull would fail
+        if len(hull_points) < 3:
+            raise ValueError("Can't find a convex hull, the points have no area")
+        return hull_points
+
+    try:
+        hull = ConvexHull(points)
+    except QhullError as e:
+        # qhull fails on flat inputs, like points that are all on one line
+        raise ValueError("Can't find a convex hull, the points have no area") from e
 
     # import matplotlib.pyplot as plt
 
@@ -38,6 +91,4 @@ def convex_hull(points: List[V]) -> List[V]:
     # y = [hull.points[pair[1]][1] for pair in hull.vertices]
     # plt.plot(x, y)
     # plt.show()
-    hull_points = [hull.points[vertex_index] for vertex_index in hull.vertices]
-
-    return [V(float(x), float(y)) for x, y in hull_points]
+    return hull.points[hull.vertices]
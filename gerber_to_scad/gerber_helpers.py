@@ -2,11 +2,12 @@
 
 
 def get_aperture_size(aperture):
-    diameter = getattr(aperture, "diameter", 0)
-    width = getattr(aperture, "width", 0)
-    height = getattr(aperture, "height", 0)
-
-    return diameter or width or height
+    # Only look up the width and height if there's no diameter (and the height if there's no width)
+    return (
+        getattr(aperture, "diameter", 0)
+        or getattr(aperture, "width", 0)
+        or getattr(aperture, "height", 0)
+    )
 
 
 def has_wide_aperture(aperture, length=None):
@@ -21,7 +22,7 @@ def has_wide_aperture(aperture, length=None):
         return False
 
     # If the aperture is more than a 10th of the length of the object, consider it wide
-    if aperture_size and length:
+    if length:
         return aperture_size > length / 10
 
     return True
@@ -3,6 +3,9 @@ import math
 
 
 class V(object):
+    # Vectors are created in large numbers, slots keep them small and quick to access
+    __slots__ = ("x", "y")
+
     def __init__(self, x: float = 0, y: float = 0):
         self.x = float(x)
         self.y = float(y)
@@ -30,21 +33,21 @@ class V(object):
     @classmethod
     def intersection(cls, o1, d1, o2, d2):
         """Find intersection of two vectors, if any"""
-        try:
-            l2 = ((o2.x - o1.x) * d1.y / d1.x - o2.y + o1.y) / (
-                d2.y - d2.x * d1.y / d1.x
-            )
-            return o2 + d2 * l2
-        except ZeroDivisionError:
+        denominator = d1.x * d2.y - d1.y * d2.x
+        # Parallel lines don't intersect
+        if denominator == 0:
             return None
 
+        l1 = ((o2.x - o1.x) * d2.y - (o2.y - o1.y) * d2.x) / denominator
+        return V(o1.x + d1.x * l1, o1.y + d1.y * l1)
+
     @classmethod
     def point_line_projection(cls, v1, v2, p, limit_to_segment=False):
         """Returns the projection of the point p on the line defined
         by the two endpoints v1 and v2
         """
         d = v2 - v1
-        l2 = d.abs_sq()
+        l2 = d.x * d.x + d.y * d.y
 
         # If v1 and v2 are equal, simply return v1 (the line direction is undefined)
         if l2 == 0:
@@ -64,16 +67,11 @@ class V(object):
 
     def abs_sq(self):
         """Square of absolute value of vector self"""
-        return abs(self.x * self.x + self.y * self.y)
-
-    def consume_tuple(self, other):
-        if isinstance(other, tuple) or isinstance(other, list):
-            return V(other[0], other[1])
-        return other
+        return self.x * self.x + self.y * self.y
 
     def cross(self, other):
         """cross product"""
-        return V(self.x * other.y - other.x * self.y)
+        return self.x * other.y - other.x * self.y
 
     def rotate(self, theta, as_degrees=False):
         """Adapted from https://gist.github.com/mcleonard/5351452.
@@ -87,15 +85,7 @@ class V(object):
         return V(x, y)
 
     def __abs__(self):
-        return math.sqrt(self.abs_sq())
-
-    def __cmp__(self, other):
-        other = self.consume_tuple(other)
-        if self.x == other.x and self.y == other.y:
-            return 0
-        if abs(self) < abs(other):
-            return -1
-        return 1
+        return math.hypot(self.x, self.y)
 
     def __nonzero__(self):
         if self.x or self.y:
@@ -106,15 +96,13 @@ class V(object):
         return V(-self.x, -self.y)
 
     def __add__(self, other):
-        other = self.consume_tuple(other)
         return V(self.x + other.x, self.y + other.y)
 
     def __sub__(self, other):
-        other = self.consume_tuple(other)
         return V(self.x - other.x, self.y - other.y)
 
     def __mul__(self, other):
-        other = self.consume_tuple(other)
+        # Vectors multiply into their dot product, anything else scales the vector
         if isinstance(other, V):
             return self.x * other.x + self.y * other.y
         return V(other * self.x, other * self.y)
@@ -125,7 +113,13 @@ class V(object):
         other = float(other)
         return V(self.x / other, self.y / other)
 
-    def __eq__(self, other: "V") -> bool:
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, V):
+            return NotImplemented
         return self.x == other.x and self.y == other.y
 
+    def __hash__(self):
+        # Equal vectors have equal coordinates, so they hash the same way
+        return hash((self.x, self.y))
+
     __truediv__ = __div__
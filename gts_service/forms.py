@@ -1,9 +1,6 @@
 from django import forms
 
 
-forms.Widget()
-
-
 class UploadForm(forms.Form):
     solderpaste_file = forms.FileField(label="Solder paste layer file")
     outline_file = forms.FileField(
@@ -112,3 +112,5 @@ USE_TZ = True
 STATIC_URL = "/static/"
 
 OPENSCAD_BIN = env.str("SCAD_BINARY")
+# Seconds an STL render may take before it's given up on
+OPENSCAD_TIMEOUT = env.int("SCAD_TIMEOUT", default=300)
@@ -1,9 +1,13 @@
+import codecs
+from collections import OrderedDict
+import hashlib
 import os
-from random import randint
 import subprocess
+import tempfile
+import threading
 
 from django.conf import settings
-from django.http.response import HttpResponse
+from django.http.response import FileResponse
 from django.shortcuts import render
 
 import gerber
@@ -13,15 +17,71 @@ from gerber_to_scad import (
 from gts_service.forms import UploadForm
 import logging
 
+# Parsed gerber files by a hash of their contents, so resubmitting the same files with different
+# options doesn't parse them again
+PARSED_GERBER_CACHE_SIZE = 16
+_parsed_gerbers: "OrderedDict[bytes, object]" = OrderedDict()
+_parsed_gerbers_lock = threading.Lock()
+
 
 def _get_version():
     with open("version", "r") as f:
         return f.read()
 
 
+# The version doesn't change while the service is running, so it's only read once
+VERSION = _get_version()
+
+
+def _read_upload(uploaded_file):
+    """Reads an uploaded gerber file as text without holding a second copy of it as bytes."""
+    # Large uploads are already on disk, so they can be decoded while reading
+    if hasattr(uploaded_file, "temporary_file_path"):
+        with open(uploaded_file.temporary_file_path(), encoding="utf-8") as f:
+            return f.read()
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    text = "".join(decoder.decode(chunk) for chunk in uploaded_file.chunks())
+    return text + decoder.decode(b"", final=True)
+
+
+def _primitives_to_metric(primitive_list):
+    """Converts primitives and all of their sub-primitives to metric."""
+    for p in primitive_list:
+        if getattr(p, "units", None) == "inch":
+            p.to_metric()
+        _primitives_to_metric(getattr(p, "primitives", ()))
+
+
+def _load_gerber(uploaded_file):
+    """Parses an uploaded gerber file, reusing the result if the same file was uploaded recently."""
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    key = digest.digest()
+
+    with _parsed_gerbers_lock:
+        if key in _parsed_gerbers:
+            _parsed_gerbers.move_to_end(key)
+            return _parsed_gerbers[key]
+
+    parsed = gerber.loads(_read_upload(uploaded_file))
+    # Cached files are shared between requests, so they're converted before anyone else sees them.
+    # Converting the file skips some sub-primitives, which would otherwise be converted while
+    # another request reads them.
+    parsed.to_metric()
+    _primitives_to_metric(parsed.primitives)
+
+    with _parsed_gerbers_lock:
+        _parsed_gerbers[key] = parsed
+        while len(_parsed_gerbers) > PARSED_GERBER_CACHE_SIZE:
+            _parsed_gerbers.popitem(last=False)
+    return parsed
+
+
 def main(request):
     form = UploadForm(request.POST or None, files=request.FILES or None)
-    version = _get_version()
+    version = VERSION
     if form.is_valid():
         outline_file = form.cleaned_data["outline_file"]
         solderpaste_file = request.FILES["solderpaste_file"]
@@ -29,7 +89,7 @@ def main(request):
 
         if outline_file:
             try:
-                outline = gerber.loads(outline_file.read().decode("utf-8"))
+                outline = _load_gerber(outline_file)
             except Exception as e:
                 logging.error(e)
                 outline = None
@@ -38,7 +98,7 @@ def main(request):
                 ]
 
         try:
-            solder_paste = gerber.loads(solderpaste_file.read().decode("utf-8"))
+            solder_paste = _load_gerber(solderpaste_file)
         except Exception as e:
             logging.error(e)
             solder_paste = None
@@ -47,59 +107,70 @@ def main(request):
             ]
 
         if not form.errors:
-            output = process_gerber(
-                outline_file=outline,
-                solderpaste_file=solder_paste,
-                stencil_thickness=form.cleaned_data["stencil_thickness"],
-                include_ledge=form.cleaned_data["include_ledge"],
-                ledge_thickness=form.cleaned_data["ledge_thickness"],
-                gap=form.cleaned_data["gap"],
-                include_frame=form.cleaned_data["include_frame"],
-                frame_width=form.cleaned_data["frame_width"],
-                frame_height=form.cleaned_data["frame_height"],
-                frame_thickness=form.cleaned_data["frame_thickness"],
-                increase_hole_size_by=form.cleaned_data["increase_hole_size_by"],
-                simplify_regions=form.cleaned_data["simplify_regions"],
-                flip_stencil=form.cleaned_data["flip_stencil"],
-                stencil_width=form.cleaned_data["stencil_width"],
-                stencil_height=form.cleaned_data["stencil_height"],
-                stencil_margin=form.cleaned_data["stencil_margin"],
-            )
-
-            file_id = randint(1000000000, 9999999999)
-            scad_filename = "/tmp/gts-{}.scad".format(file_id)
-            stl_filename = "/tmp/gts-{}.stl".format(file_id)
-
-            with open(scad_filename, "w") as scad_file:
-                scad_file.write(output)
-
-            p = subprocess.Popen(
-                [
-                    settings.OPENSCAD_BIN,
-                    "-o",
-                    stl_filename,
-                    scad_filename,
-                ]
-            )
-            p.wait()
-
-            if p.returncode:
-                form.errors["__all__"] = ["Failed to create an STL file from inputs"]
-            else:
-                with open(stl_filename, "r") as stl_file:
-                    stl_data = stl_file.read()
-                os.remove(stl_filename)
-
-            # Clean up temporary files
-            os.remove(scad_filename)
+            # Everything in the directory is removed when it's closed, even if rendering fails
+            with tempfile.TemporaryDirectory(prefix="gts-") as temp_dir:
+                stl_name = f"{os.path.basename(temp_dir)}.stl"
+                scad_filename = os.path.join(temp_dir, "stencil.scad")
+                stl_filename = os.path.join(temp_dir, stl_name)
+
+                with open(scad_filename, "w") as scad_file:
+                    process_gerber(
+                        outline_file=outline,
+                        solderpaste_file=solder_paste,
+                        stencil_thickness=form.cleaned_data["stencil_thickness"],
+                        include_ledge=form.cleaned_data["include_ledge"],
+                        ledge_thickness=form.cleaned_data["ledge_thickness"],
+                        gap=form.cleaned_data["gap"],
+                        include_frame=form.cleaned_data["include_frame"],
+                        frame_width=form.cleaned_data["frame_width"],
+                        frame_height=form.cleaned_data["frame_height"],
+                        frame_thickness=form.cleaned_data["frame_thickness"],
+                        increase_hole_size_by=form.cleaned_data[
+                            "increase_hole_size_by"
+                        ],
+                        simplify_regions=form.cleaned_data["simplify_regions"],
+                        flip_stencil=form.cleaned_data["flip_stencil"],
+                        stencil_width=form.cleaned_data["stencil_width"],
+                        stencil_height=form.cleaned_data["stencil_height"],
+                        stencil_margin=form.cleaned_data["stencil_margin"],
+                        scad_file=scad_file,
+                    )
+
+                try:
+                    # run() kills the render if it times out, so a stuck one can't hold on to
+                    # the request thread
+                    render_failed = bool(
+                        subprocess.run(
+                            [
+                                settings.OPENSCAD_BIN,
+                                "-o",
+                                stl_filename,
+                                scad_filename,
+                            ],
+                            timeout=settings.OPENSCAD_TIMEOUT,
+                        ).returncode
+                    )
+                except subprocess.TimeoutExpired:
+                    render_failed = True
+
+                if render_failed:
+                    form.errors["__all__"] = [
+                        "Failed to create an STL file from inputs"
+                    ]
+                else:
+                    # The open file stays readable after the directory is removed, until the
+                    # response closes it
+                    stl_file = open(stl_filename, "rb")
 
         if form.errors:
             return render(request, "main.html", {"form": form, "version": version})
 
-        response = HttpResponse(stl_data, content_type="application/zip")
-        response["Content-Disposition"] = (
-            "attachment; filename=%s" % stl_filename.rsplit("/")[-1]
+        # Streams the STL from the file instead of copying it into the response
+        return FileResponse(
+            stl_file,
+            as_attachment=True,
+            filename=stl_name,
+            content_type="model/stl",
         )
-        return response
 
     return render(request, "main.html", {"form": form, "version": version})
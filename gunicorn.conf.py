@@ -0,0 +1,12 @@
+"""Gunicorn settings for the web service
+
+Rendering stencils is CPU-bound, so the work is spread over one worker process per core. Threads
+only cover requests that are waiting on OpenSCAD or the network.
+"""
+
+import multiprocessing
+import os
+
+workers = int(os.environ.get("GTS_WORKERS", str(multiprocessing.cpu_count())))
+threads = int(os.environ.get("GTS_THREADS", "2"))
+worker_class = "gthread"